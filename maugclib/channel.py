@@ -34,6 +34,11 @@ from mautrix.util.opt_prometheus import Counter
 from . import event, exceptions, googlechat_pb2, http_utils, pblite
 from .exceptions import SIDExpiringError, SIDInvalidError
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 logger = logging.getLogger(__name__)
 Utf8IncrementalDecoder = codecs.getincrementaldecoder("utf-8")
 LEN_REGEX = re.compile(r"([0-9]+)\n", re.MULTILINE)
@@ -322,7 +327,7 @@ class Channel:
         }
 
         body = pblite.encode(events_request)
-        json_body = json.dumps(body)
+        json_body = orjson.dumps(body).decode() if orjson else json.dumps(body)
         data = {
             "count": 1,
             "ofs": self._ofs,
@@ -11,9 +11,7 @@ Google's implementation for JavaScript is available in closure-library:
     https://github.com/google/closure-library/tree/master/closure/goog/proto2
 """
 
-import base64
-import itertools
-import json
+from binascii import b2a_base64
 import logging
 
 # pylint: disable=no-name-in-module,import-error
@@ -21,53 +19,47 @@ from google.protobuf.descriptor import FieldDescriptor
 
 # pylint: enable=no-name-in-module,import-error
 
+try:
+    # pybase64 uses SIMD base64 kernels, which are much faster for big values.
+    # Neither function validates the input by default.
+    from pybase64 import b64decode
+except ImportError:
+    from binascii import a2b_base64 as b64decode
+
 
 logger = logging.getLogger(__name__)
 
+_TYPE_MESSAGE = FieldDescriptor.TYPE_MESSAGE
+_TYPE_BYTES = FieldDescriptor.TYPE_BYTES
+_TYPE_INT64 = FieldDescriptor.TYPE_INT64
+_LABEL_REPEATED = FieldDescriptor.LABEL_REPEATED
 
-def _decode_field(message, field, value):
-    """Decode optional or required field."""
-    if field.type == FieldDescriptor.TYPE_MESSAGE:
-        decode(getattr(message, field.name), value)
-    else:
-        try:
-            if field.type == FieldDescriptor.TYPE_BYTES:
-                value = base64.b64decode(value)
-            elif field.type == FieldDescriptor.TYPE_INT64:
-                value = int(value)
-            setattr(message, field.name, value)
-        except (ValueError, TypeError) as e:
-            # ValueError: invalid enum value, negative unsigned int value, or
-            # invalid base64
-            # TypeError: mismatched type
-            logger.warning(
-                "Message %r ignoring field %s: %s", message.__class__.__name__, field.name, e
-            )
-
-
-def _decode_repeated_field(message, field, value_list):
-    """Decode repeated field."""
-    if field.type == FieldDescriptor.TYPE_MESSAGE:
-        for value in value_list:
-            decode(getattr(message, field.name).add(), value)
-    else:
-        try:
-            for value in value_list:
-                if field.type == FieldDescriptor.TYPE_BYTES:
-                    value = base64.b64decode(value)
-                getattr(message, field.name).append(value)
-        except (ValueError, TypeError) as e:
-            # ValueError: invalid enum value, negative unsigned int value, or
-            # invalid base64
-            # TypeError: mismatched type
-            logger.warning(
-                "Message %r ignoring repeated field %s: %s",
-                message.__class__.__name__,
-                field.name,
-                e,
-            )
-            # Ignore any values already decoded by clearing list
-            message.ClearField(field.name)
+
+# Fields with numbers up to this are looked up from a list indexed by the field
+# number, higher ones from a dict.
+_MAX_DENSE_FIELD_NUMBER = 256
+
+# Per-descriptor decoding plans, see _build_decode_plan.
+_DECODE_PLANS = {}
+
+
+def _build_decode_plan(descriptor):
+    """Build the field lookup tables used when decoding a message type.
+
+    Each field is represented as a (name, repeated, type) tuple. Returns a
+    tuple of a list of fields indexed by field number (with None for unused
+    numbers) and a dict of any fields with numbers too high to fit in the list.
+    """
+    fields = {
+        number: (field.name, field.label == _LABEL_REPEATED, field.type)
+        for number, field in descriptor.fields_by_number.items()
+    }
+    dense_len = min(max(fields, default=0), _MAX_DENSE_FIELD_NUMBER) + 1
+    dense = [fields.get(number) for number in range(dense_len)]
+    sparse = {number: field for number, field in fields.items() if number >= dense_len}
+    plan = (dense, sparse)
+    _DECODE_PLANS[descriptor] = plan
+    return plan
 
 
 def decode(message, pblite, ignore_first_item=False):
@@ -81,6 +73,10 @@ def decode(message, pblite, ignore_first_item=False):
     of the protobuf message (eg.  cscmrp for ClientSendChatMessageResponseP)
     that's not part of the protobuf.
 
+    Messages and the trailing extra field mappings are detected by exact type,
+    so subclasses of list and dict aren't supported. json.loads never returns
+    them.
+
     Args:
         message: protocol buffer message instance to decode into.
         pblite: list representing a pblite-serialized message.
@@ -88,7 +84,7 @@ def decode(message, pblite, ignore_first_item=False):
             list, making the item at index 1 correspond to field 1 in the
             message.
     """
-    if not isinstance(pblite, list):
+    if type(pblite) is not list:
         logger.warning("Ignoring invalid message: expected list, got %r", type(pblite))
         return
     if ignore_first_item:
@@ -96,22 +92,36 @@ def decode(message, pblite, ignore_first_item=False):
     # If the last item of the list is a dict, use it as additional field/value
     # mappings. This seems to be an optimization added for dealing with really
     # high field numbers.
-    if pblite and isinstance(pblite[-1], dict):
+    if pblite and type(pblite[-1]) is dict:
         extra_fields = {int(field_number): value for field_number, value in pblite[-1].items()}
         pblite = pblite[:-1]
     else:
         extra_fields = {}
-    fields_values = itertools.chain(enumerate(pblite, start=1), extra_fields.items())
+    descriptor = message.DESCRIPTOR
+    plan = _DECODE_PLANS.get(descriptor)
+    if plan is None:
+        plan = _build_decode_plan(descriptor)
+    _decode_fields(message, plan, enumerate(pblite, start=1))
+    if extra_fields:
+        _decode_fields(message, plan, extra_fields.items())
+
+
+def _decode_fields(message, plan, fields_values):
+    """Decode (field number, value) pairs into a message."""
+    dense, sparse = plan
+    dense_len = len(dense)
     for field_number, value in fields_values:
         if value is None:
             continue
-        try:
-            field = message.DESCRIPTOR.fields_by_number[field_number]
-        except KeyError:
+        if 0 <= field_number < dense_len:
+            field = dense[field_number]
+        else:
+            field = sparse.get(field_number)
+        if field is None:
             # If the tag number is unknown and the value is non-trivial, log a
             # message to aid reverse-engineering the missing field in the
             # message.
-            if value not in [[], "", 0]:
+            if logger.isEnabledFor(logging.DEBUG) and value != [] and value != "" and value != 0:
                 logger.debug(
                     "Message %r contains unknown field %s with value " "%r",
                     message.__class__.__name__,
@@ -119,22 +129,87 @@ def decode(message, pblite, ignore_first_item=False):
                     value,
                 )
             continue
-        if field.label == FieldDescriptor.LABEL_REPEATED:
-            _decode_repeated_field(message, field, value)
+        name, repeated, field_type = field
+        if field_type == _TYPE_MESSAGE:
+            if repeated:
+                add = getattr(message, name).add
+                for item in value:
+                    decode(add(), item)
+            else:
+                decode(getattr(message, name), value)
+        elif repeated:
+            try:
+                # Values that aren't lists are iterated item by item like
+                # lists (so a string adds one item per character), and
+                # anything that isn't iterable is a mismatched type.
+                if field_type == _TYPE_BYTES:
+                    value = [b64decode(item) for item in value]
+                elif type(value) is not list:
+                    value = list(value)
+                # Even extending with an empty list marks the message as
+                # present, so only touch the container if there are items.
+                if value:
+                    getattr(message, name).extend(value)
+            except (ValueError, TypeError) as e:
+                # ValueError: invalid enum value, negative unsigned int value, or
+                # invalid base64
+                # TypeError: mismatched type
+                logger.warning(
+                    "Message %r ignoring repeated field %s: %s",
+                    message.__class__.__name__,
+                    name,
+                    e,
+                )
+                # Ignore any values already decoded by clearing list
+                message.ClearField(name)
         else:
-            _decode_field(message, field, value)
+            try:
+                if field_type == _TYPE_BYTES:
+                    value = b64decode(value)
+                elif field_type == _TYPE_INT64:
+                    value = int(value)
+                setattr(message, name, value)
+            except (ValueError, TypeError) as e:
+                # ValueError: invalid enum value, negative unsigned int value, or
+                # invalid base64
+                # TypeError: mismatched type
+                logger.warning(
+                    "Message %r ignoring field %s: %s", message.__class__.__name__, name, e
+                )
 
 
-def _encode_field(message, field):
-    ret = None
+def _encode_repeated_message(items):
+    return [encode(item) for item in items]
+
+
+def _encode_bytes(value):
+    return b2a_base64(value, newline=False).decode()
+
+
+def _encode_repeated_bytes(items):
+    return [b2a_base64(item, newline=False).decode() for item in items]
 
-    if field.type == FieldDescriptor.TYPE_MESSAGE:
-        nested = getattr(message, field.name)
-        ret = encode(nested)
-    else:
-        ret = getattr(message, field.name)
 
-    return ret
+# Per-descriptor encoding plans, mapping each field descriptor of a message
+# type to its index in the pblite list and the function used to encode its
+# value, or None if the value can be used as-is.
+# Descriptors live for the lifetime of the process, so this is never cleared.
+_ENCODE_PLANS = {}
+
+
+def _build_encode_plan(descriptor):
+    plan = {}
+    for field in descriptor.fields:
+        repeated = field.label == _LABEL_REPEATED
+        if field.type == _TYPE_MESSAGE:
+            encoder = _encode_repeated_message if repeated else encode
+        elif field.type == _TYPE_BYTES:
+            encoder = _encode_repeated_bytes if repeated else _encode_bytes
+        else:
+            encoder = list if repeated else None
+        plan[field] = (field.number - 1, encoder)
+    _ENCODE_PLANS[descriptor] = plan
+    return plan
 
 
 def encode(message):
@@ -151,26 +226,19 @@ def encode(message):
     """
     if not message.IsInitialized():
         raise ValueError("Can not encode message: one or more required fields " "are not set")
-    pblite = []
+    descriptor = message.DESCRIPTOR
+    plan = _ENCODE_PLANS.get(descriptor)
+    if plan is None:
+        plan = _build_encode_plan(descriptor)
     # ListFields only returns fields that are set, so use this to only encode
     # necessary fields
-    for field_descriptor, field_value in message.ListFields():
-        if field_descriptor.label == FieldDescriptor.LABEL_REPEATED:
-            if field_descriptor.type == FieldDescriptor.TYPE_MESSAGE:
-                encoded_value = [encode(item) for item in field_value]
-            elif field_descriptor.type == FieldDescriptor.TYPE_BYTES:
-                encoded_value = [base64.b64encode(val).decode() for val in field_value]
-            else:
-                encoded_value = list(field_value)
-        else:
-            if field_descriptor.type == FieldDescriptor.TYPE_MESSAGE:
-                encoded_value = encode(field_value)
-            elif field_descriptor.type == FieldDescriptor.TYPE_BYTES:
-                encoded_value = base64.b64encode(field_value).decode()
-            else:
-                encoded_value = field_value
-        # Add any necessary padding to the list
-        required_padding = max(field_descriptor.number - len(pblite), 0)
-        pblite.extend([None] * required_padding)
-        pblite[field_descriptor.number - 1] = encoded_value
+    fields = message.ListFields()
+    if not fields:
+        return []
+    # The fields are ordered by number, so the last one determines the length
+    # of the list and it can be allocated with all the padding in one go.
+    pblite = [None] * (plan[fields[-1][0]][0] + 1)
+    for field_descriptor, field_value in fields:
+        index, encoder = plan[field_descriptor]
+        pblite[index] = field_value if encoder is None else encoder(field_value)
     return pblite